@@ -1,19 +1,32 @@
 import os
+import re
+import hashlib
+import tempfile
 from datetime import datetime
-from decimal import Decimal
+from decimal import Decimal, InvalidOperation
+from urllib.parse import urlencode
 from dotenv import load_dotenv
 from flask import (
     Flask, render_template, redirect, url_for,
     request, flash, session, abort
 )
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import func
+from flask_caching import Cache
+from flask_limiter import Limiter
+from flask_limiter.util import get_remote_address
+from jinja2 import FileSystemBytecodeCache
+from whitenoise import WhiteNoise
+from PIL import Image, UnidentifiedImageError
+from sqlalchemy import DDL, Integer, event, func, select, text, update
+from sqlalchemy.orm import selectinload
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from flask_login import (
     LoginManager, login_user, logout_user,
     login_required, current_user, UserMixin
 )
-from werkzeug.security import generate_password_hash, check_password_hash
-from werkzeug.utils import secure_filename
+from werkzeug.security import check_password_hash
+from argon2 import PasswordHasher
+from argon2.exceptions import InvalidHashError, VerifyMismatchError
 from functools import wraps
 
 # ────────────  базовая конфигурация  ────────────
@@ -26,15 +39,76 @@ app = Flask(
     static_folder=os.path.join(BASE_DIR, "static"),
 )
 
+# скомпилированные шаблоны храним на диске, чтобы не разбирать их заново после рестарта
+JINJA_CACHE_DIR = os.path.join(BASE_DIR, ".jinja_cache")
+os.makedirs(JINJA_CACHE_DIR, exist_ok=True)
+app.jinja_env.bytecode_cache = FileSystemBytecodeCache(JINJA_CACHE_DIR)
+
+# статику отдаёт WhiteNoise, минуя роутинг Flask. Обложки названы по хэшу
+# содержимого, поэтому их можно кэшировать в браузере навсегда
+COVER_URL_RE = re.compile(r"^/static/uploads/[0-9a-f]{32}\.\w+$")
+COVER_MAX_AGE = 31536000  # год
+
+app.wsgi_app = WhiteNoise(
+    app.wsgi_app,
+    root=os.path.join(BASE_DIR, "static"),
+    prefix="static/",
+    immutable_file_test=COVER_URL_RE.pattern,
+)
+
+@app.after_request
+def cache_uploaded_covers(response):
+    # WhiteNoise знает только файлы, бывшие на диске при старте; обложки,
+    # загруженные позже, отдаёт static-view Flask – им тоже ставим вечный кэш
+    if (request.endpoint == "static" and response.status_code in (200, 304)
+            and COVER_URL_RE.match(request.path)):
+        cc = response.cache_control
+        cc.no_cache = None
+        cc.public = True
+        cc.max_age = COVER_MAX_AGE
+        cc.immutable = True
+    return response
+
 app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///" + os.path.join(os.path.dirname(__file__), "buk.db")
 app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
-app.config["UPLOAD_FOLDER"] = "static/uploads"
-app.config["ALLOWED_EXTENSIONS"] = {"png", "jpg", "jpeg", "gif"}
+app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
+    # timeout – сколько ждать снятия блокировки записи, прежде чем упасть
+    "connect_args": {"check_same_thread": False, "timeout": 30},
+    # кэш скомпилированных select(): запросы каталога/корзины/админки с разными
+    # наборами фильтров дают много вариантов SQL
+    "query_cache_size": 1200,
+}
+app.config["UPLOAD_FOLDER"] = os.path.join(BASE_DIR, "static", "uploads")
 app.config["SECRET_KEY"] = os.getenv("SECRET_KEY", "dev-secret")
+app.config["PER_PAGE"] = 30
 
 db = SQLAlchemy(app)
 login_manager = LoginManager(app)
 login_manager.login_view = "login"
+cache = Cache(app, config={"CACHE_TYPE": "SimpleCache", "CACHE_DEFAULT_TIMEOUT": 60})
+# ограничение частоты попыток входа/регистрации: подбор пароля
+# медленный сам по себе, но каждая попытка стоит 46 МиБ памяти и CPU на Argon2
+limiter = Limiter(get_remote_address, app=app, storage_uri="memory://")
+
+# Argon2id, параметры по рекомендации OWASP: 46 МиБ памяти, 1 проход, 1 поток
+password_hasher = PasswordHasher(time_cost=1, memory_cost=46 * 1024, parallelism=1)
+
+SQLITE_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",       # чтение не блокируется записью
+    "PRAGMA synchronous=NORMAL",     # в режиме WAL безопасно и без fsync на каждый commit
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA mmap_size=268435456",
+    "PRAGMA cache_size=-20000",      # ~20 МБ страничного кэша
+)
+
+def _set_sqlite_pragmas(dbapi_conn, _record):
+    cursor = dbapi_conn.cursor()
+    for pragma in SQLITE_PRAGMAS:
+        cursor.execute(pragma)
+    cursor.close()
+
+with app.app_context():
+    event.listen(db.engine, "connect", _set_sqlite_pragmas)
 
 # ────────────  модели  ────────────
 class User(UserMixin, db.Model):
@@ -47,14 +121,31 @@ class User(UserMixin, db.Model):
     status = db.Column(db.Enum("active", "banned", "pending", name="user_status"), default="active")
     is_admin = db.Column(db.Boolean, default=False)
 
-    books = db.relationship("Book", back_populates="owner")
+    # lazy="raise": книги пользователя загружаются только явным запросом (см. my_books)
+    books = db.relationship("Book", back_populates="owner", lazy="raise")
     orders = db.relationship("Order", back_populates="user")
 
     def set_password(self, pw):
-        self.password_hash = generate_password_hash(pw)
+        self.password_hash = password_hasher.hash(pw)
 
     def check_password(self, pw):
-        return check_password_hash(self.password_hash, pw)
+        """
+        Проверить пароль. Старые хэши Werkzeug (pbkdf2/scrypt) проверяются
+        как раньше и при успешном входе заменяются на Argon2id.
+        """
+        if not self.password_hash.startswith("$argon2"):
+            if not check_password_hash(self.password_hash, pw):
+                return False
+            self.set_password(pw)
+            return True
+
+        try:
+            password_hasher.verify(self.password_hash, pw)
+        except (VerifyMismatchError, InvalidHashError):
+            return False
+        if password_hasher.check_needs_rehash(self.password_hash):
+            self.set_password(pw)
+        return True
 
 
     @property
@@ -73,6 +164,10 @@ class Category(db.Model):
 
     books = db.relationship("Book", back_populates="category")
 
+    __table_args__ = (
+        db.Index("ux_categories_name_lower", func.lower(name), unique=True),
+    )
+
 
 class Book(db.Model):
     __tablename__ = "books"
@@ -81,25 +176,30 @@ class Book(db.Model):
     author = db.Column(db.String(150), nullable=False)
     year = db.Column(db.Integer)
     description = db.Column(db.Text)
-    price = db.Column(db.Numeric(10, 2), nullable=False)
+    price = db.Column(db.Integer, nullable=False, index=True)  # в копейках
     cover = db.Column(db.String(255))  # путь к изображению
     status = db.Column(db.Enum("отличное", "хорошее", "среднее", "плохое", name="book_condition"), default="хорошее")
     owner_id = db.Column(db.Integer, db.ForeignKey("users.id"))
-    category_id = db.Column(db.Integer, db.ForeignKey("categories.id"))
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    category_id = db.Column(db.Integer, db.ForeignKey("categories.id"), index=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
 
-    is_available = db.Column(db.Boolean, nullable=False, default=True)
+    is_available = db.Column(db.Boolean, nullable=False, default=True, index=True)
 
     owner = db.relationship("User", back_populates="books")
     category = db.relationship("Category", back_populates="books")
 
+    __table_args__ = (
+        # каталог: доступные книги, свежие сверху
+        db.Index("ix_books_avail_created", "is_available", "created_at"),
+    )
+
 
 class Order(db.Model):
     __tablename__ = "orders"
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey("users.id"))
     creation_date = db.Column(db.Date, default=datetime.utcnow)
-    total = db.Column(db.Numeric(10, 2))
+    total = db.Column(db.Integer)  # в копейках
     status = db.Column(
         db.Enum("new", "processing", "completed", "cancelled", name="order_status"),
         default="new"
@@ -113,27 +213,168 @@ class Order(db.Model):
     user = db.relationship("User", back_populates="orders")
     items = db.relationship("OrderItem", back_populates="order", cascade="all, delete-orphan")
 
+    __table_args__ = (
+        # история заказов пользователя без отменённых
+        db.Index("ix_orders_user_status", "user_id", "status"),
+    )
+
 
 class OrderItem(db.Model):
     __tablename__ = "order_items"
     id = db.Column(db.Integer, primary_key=True)
-    order_id = db.Column(db.Integer, db.ForeignKey("orders.id"))
-    book_id = db.Column(db.Integer, db.ForeignKey("books.id"))
-    price_at_time = db.Column(db.Numeric(10, 2))
+    order_id = db.Column(db.Integer, db.ForeignKey("orders.id"), index=True)
+    book_id = db.Column(db.Integer, db.ForeignKey("books.id"), index=True)
+    price_at_time = db.Column(db.Integer)  # в копейках
     quantity = db.Column(db.Integer, default=1)
 
     order = db.relationship("Order", back_populates="items")
     book = db.relationship("Book")
 
+# полнотекстовый индекс FTS5 по названию и автору; содержимое берётся из books,
+# триггеры держат индекс в актуальном состоянии
+BOOKS_FTS_DDL = (
+    """CREATE VIRTUAL TABLE IF NOT EXISTS books_fts USING fts5(
+        title, author, content='books', content_rowid='id',
+        tokenize='unicode61 remove_diacritics 2'
+    )""",
+    """CREATE TRIGGER IF NOT EXISTS books_fts_ai AFTER INSERT ON books BEGIN
+        INSERT INTO books_fts(rowid, title, author) VALUES (new.id, new.title, new.author);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS books_fts_ad AFTER DELETE ON books BEGIN
+        INSERT INTO books_fts(books_fts, rowid, title, author)
+        VALUES ('delete', old.id, old.title, old.author);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS books_fts_au AFTER UPDATE OF title, author ON books BEGIN
+        INSERT INTO books_fts(books_fts, rowid, title, author)
+        VALUES ('delete', old.id, old.title, old.author);
+        INSERT INTO books_fts(rowid, title, author) VALUES (new.id, new.title, new.author);
+    END""",
+)
+for _stmt in BOOKS_FTS_DDL:
+    event.listen(Book.__table__, "after_create", DDL(_stmt))
+
 # ────────────  util  ────────────
 @login_manager.user_loader
 def load_user(uid): return db.session.get(User, int(uid))
 
+ALLOWED_EXTENSIONS = frozenset({".png", ".jpg", ".jpeg", ".gif"})
+# формат, определённый Pillow по содержимому → расширение сохранённой обложки
+IMAGE_EXTENSIONS = {"PNG": ".png", "JPEG": ".jpg", "GIF": ".gif"}
+
 def allowed_file(fname):
-    return "." in fname and fname.rsplit(".", 1)[1].lower() in app.config["ALLOWED_EXTENSIONS"]
+    return os.path.splitext(fname)[1].lower() in ALLOWED_EXTENSIONS
 
-def cart_count(): return len(session.get("cart", []))
-app.jinja_env.globals["cart_count"] = cart_count   # для бейджика в навигации
+def image_extension(file) -> str | None:
+    """
+    Проверить по заголовку, что загруженный файл – действительно картинка,
+    а не что-то с подставленным расширением, и вернуть расширение по её формату
+    (None – не картинка). Поток возвращается в начало.
+    """
+    try:
+        with Image.open(file.stream) as img:
+            img.verify()
+            return IMAGE_EXTENSIONS.get(img.format)
+    except (UnidentifiedImageError, Image.DecompressionBombError, OSError, SyntaxError):
+        return None
+    finally:
+        file.stream.seek(0)
+
+# предел прежней колонки Numeric(10, 2): 99 999 999.99 ₽
+MAX_PRICE = 99_999_999_99
+
+def parse_price(raw: str) -> int:
+    """
+    "12,5" / "12.50" → 1250. Деньги храним целыми копейками,
+    Decimal нужен только здесь, на разборе ввода.
+    Нечисловое или выходящее за MAX_PRICE значение – ValueError.
+    """
+    try:
+        cents = int(Decimal(raw.strip().replace(",", ".")).quantize(Decimal("0.01")) * 100)
+    except InvalidOperation:
+        raise ValueError(f"некорректная цена: {raw!r}") from None
+    if abs(cents) > MAX_PRICE:
+        raise ValueError(f"цена вне допустимого диапазона: {raw!r}")
+    return cents
+
+@app.template_filter("money")
+def money(cents: int | None) -> str:
+    """Копейки → строка для шаблона: 1250 → 12.50"""
+    cents = cents or 0
+    sign = "-" if cents < 0 else ""
+    rub, kop = divmod(abs(cents), 100)
+    return f"{sign}{rub}.{kop:02d}"
+
+def fts_query(search: str) -> str:
+    """
+    Строка поиска → запрос FTS5: каждое слово в кавычках (чтобы спецсимволы
+    не разбирались как синтаксис MATCH) и с * для поиска по началу слова.
+    """
+    return " ".join('"{}"*'.format(word.replace('"', '""')) for word in search.split())
+
+@app.template_global()
+def page_url(param: str, page: int) -> str:
+    """
+    Ссылка на страницу списка: текущий URL с заменённым параметром страницы.
+    Query-строка собирается здесь, а не через url_for(**request.args), чтобы
+    параметры вроде _external/_anchor/endpoint не попадали в url_for.
+    """
+    args = request.args.copy()
+    args[param] = page
+    base = url_for(request.endpoint, **(request.view_args or {}))
+    return base + "?" + urlencode(list(args.items(multi=True)))
+
+def get_cart() -> dict:
+    """
+    Корзина в сессии: {"<book_id>": 1, ...} – ключи строками, т.к. сессия хранится в JSON.
+    """
+    cart = session.get("cart") or {}
+    if isinstance(cart, list):  # старый формат – список id
+        cart = {str(bid): 1 for bid in cart}
+        session["cart"] = cart
+    return cart
+
+def cart_book_ids() -> list[int]:
+    return [int(bid) for bid in get_cart()]
+
+def save_upload(file, ext: str) -> str:
+    """
+    Сохранить загруженный файл в UPLOAD_FOLDER под именем-хэшем содержимого.
+    Файл читается кусками по 64 КБ во временный файл и затем переименовывается,
+    уже существующая обложка с тем же содержимым не перезаписывается.
+    """
+    folder = app.config["UPLOAD_FOLDER"]
+    os.makedirs(folder, exist_ok=True)
+
+    digest = hashlib.blake2b(digest_size=16)
+    with tempfile.NamedTemporaryFile(dir=folder, prefix=".upload-", delete=False) as tmp:
+        for chunk in iter(lambda: file.stream.read(64 * 1024), b""):
+            digest.update(chunk)
+            tmp.write(chunk)
+
+    fname = f"{digest.hexdigest()}{ext}"
+    target = os.path.join(folder, fname)
+    if os.path.exists(target):
+        os.remove(tmp.name)
+    else:
+        os.chmod(tmp.name, 0o644)  # NamedTemporaryFile создаёт файл с правами 0600
+        os.replace(tmp.name, target)
+    return fname
+
+@app.context_processor
+def inject_cart_count():
+    # для бейджика в навигации: считаем один раз на рендер, шаблон читает переменную
+    return {"cart_count": len(session.get("cart", {}))}
+
+def invalidate_catalog() -> None:
+    """
+    Сбросить закэшированные страницы каталога.
+    Вызывается после любых изменений, влияющих на список книг.
+    """
+    cache.clear()
+
+def _skip_catalog_cache() -> bool:
+    # кэшируем только гостевую выдачу без flash-сообщений
+    return current_user.is_authenticated or "_flashes" in session
 
 def admin_required(view_func):
     @wraps(view_func)
@@ -146,21 +387,31 @@ def admin_required(view_func):
 
 def recalc_order_total(order: Order) -> None:
     """
-    Пересчитать сумму заказа по таблице order_items.
+    Пересчитать сумму заказа по таблице order_items
+    одним UPDATE с подзапросом, без чтения суммы в Python.
     """
-    total = (
-        db.session.query(
-            func.coalesce(
-                func.sum(OrderItem.price_at_time * OrderItem.quantity),
-                0
-            )
-        )
-        .filter(OrderItem.order_id == order.id)
-        .scalar()
+    items_total = (
+        select(func.coalesce(func.sum(OrderItem.price_at_time * OrderItem.quantity), 0))
+        .where(OrderItem.order_id == order.id)
+        .scalar_subquery()
     )
+    db.session.execute(
+        update(Order)
+        .where(Order.id == order.id)
+        .values(total=items_total)
+        .execution_options(synchronize_session=False)
+    )
+    # значение в объекте устарело – перечитается из БД при обращении
+    db.session.expire(order, ["total"])
 
-    # total приходит как Decimal или int, приводим к Decimal с 2 знаками
-    order.total = Decimal(str(total)).quantize(Decimal("0.01"))
+def release_books(book_ids: list[int]) -> None:
+    """
+    Вернуть книги в каталог одним UPDATE вместо загрузки каждой книги.
+    """
+    if book_ids:
+        db.session.execute(
+            update(Book).where(Book.id.in_(book_ids)).values(is_available=True)
+        )
 
 # ────────────  маршруты  ────────────
 @app.route("/")
@@ -168,14 +419,16 @@ def index(): return redirect(url_for("books"))
 
 # ----------  каталог + фильтр  ----------
 @app.route("/books")
+@cache.cached(timeout=60, query_string=True, unless=_skip_catalog_cache)
 def books():
     # Базовый запрос: берём только те книги, которые
     # НЕ находятся в активных заказах (статус != 'cancelled')
     query = (
-        Book.query
+        select(Book)
+        .options(selectinload(Book.category))
         .outerjoin(OrderItem, OrderItem.book_id == Book.id)
         .outerjoin(Order, OrderItem.order_id == Order.id)
-        .filter(
+        .where(
             db.or_(
                 Order.id == None,            # книги без заказов
                 Order.status == "cancelled"  # или в отменённых заказах
@@ -192,34 +445,44 @@ def books():
     min_p    = request.args.get("min_price")
     max_p    = request.args.get("max_price")
 
-    # 🔍 поиск по названию или автору (без lower, чтобы не ломать кириллицу)
+    # 🔍 поиск по названию или автору через FTS5 (регистр, в т.ч. кириллицы, не важен)
     if search:
-        like = f"%{search}%"
-        query = query.filter(
-            db.or_(
-                Book.title.like(like),
-                Book.author.like(like),
-            )
-        )
+        query = query.where(Book.id.in_(
+            text("SELECT rowid FROM books_fts WHERE books_fts MATCH :q")
+            .bindparams(q=fts_query(search))
+            .columns(rowid=Integer)
+        ))
 
     # --- ФИЛЬТРЫ (НЕ ТРОГАЕМ) ---
     if genre_id:
-        query = query.join(Category).filter(Category.id == genre_id)
+        query = query.join(Category).where(Category.id == genre_id)
 
     if author:
-        query = query.filter(Book.author.ilike(f"%{author}%"))
-
-    if min_p:
-        query = query.filter(Book.price >= Decimal(min_p))
-    if max_p:
-        query = query.filter(Book.price <= Decimal(max_p))
-
-    books_ = query.order_by(Book.created_at.desc()).all()
-    categories = Category.query.order_by(Category.name.asc()).all()
+        query = query.where(Book.author.ilike(f"%{author}%"))
+
+    # некорректную границу цены просто не применяем
+    try:
+        if min_p:
+            query = query.where(Book.price >= parse_price(min_p))
+        if max_p:
+            query = query.where(Book.price <= parse_price(max_p))
+    except ValueError:
+        pass
+
+    # DISTINCT: книга из нескольких отменённых заказов даёт после join несколько
+    # строк, а LIMIT/OFFSET и COUNT пагинации считают именно строки
+    pagination = db.paginate(
+        query.distinct().order_by(Book.created_at.desc()),
+        page=request.args.get("page", 1, type=int),
+        per_page=app.config["PER_PAGE"],
+        error_out=False,
+    )
+    categories = db.session.scalars(select(Category).order_by(Category.name.asc())).all()
 
     return render_template(
         "books.html",
-        books=books_,
+        books=pagination.items,
+        pagination=pagination,
         categories=categories,
         selected_genre_id=genre_id
     )
@@ -227,6 +490,7 @@ def books():
 
 # ----------  регистрация / вход / выход  ----------
 @app.route("/register", methods=["GET", "POST"])
+@limiter.limit("5/minute", methods=["POST"])
 def register():
     if current_user.is_authenticated: return redirect(url_for("books"))
     if request.method == "POST":
@@ -239,6 +503,7 @@ def register():
     return render_template("register.html")
 
 @app.route("/login", methods=["GET", "POST"])
+@limiter.limit("5/minute", methods=["POST"])
 def login():
     if current_user.is_authenticated:
         return redirect(url_for("books"))
@@ -260,6 +525,7 @@ def login():
                 return render_template("login.html")
 
             login_user(user, remember=remember)
+            db.session.commit()  # сохранить хэш, если check_password его обновил
             flash("Добро пожаловать!", "success")
             return redirect(request.args.get("next") or url_for("books"))
 
@@ -277,7 +543,12 @@ def logout(): logout_user(); flash("Вы вышли", "info"); return redirect(u
 @app.route("/my_books")
 @login_required
 def my_books():
-    return render_template("my_books.html", books=current_user.books)
+    books = db.session.scalars(
+        select(Book)
+        .where(Book.owner_id == current_user.id)
+        .order_by(Book.created_at.desc())
+    ).all()
+    return render_template("my_books.html", books=books)
 
 @app.route("/book/new", methods=["GET", "POST"])
 @login_required
@@ -306,6 +577,7 @@ def book_delete(book_id):
 
     db.session.delete(book)
     db.session.commit()
+    invalidate_catalog()
     flash("Книга удалена", "info")
     return redirect(url_for("my_books"))
 
@@ -335,14 +607,22 @@ def _book_form(book: Book | None = None):
         new_category_name = f.get("new_category", "").strip()
 
         if new_category_name:
-            # если введён новый жанр – создаём Category
-            cat = Category.query.filter(
-                db.func.lower(Category.name) == new_category_name.lower()
-            ).first()
+            # если введён новый жанр – ищем его среди уже загруженных
+            # (casefold, т.к. lower() в SQLite не понимает кириллицу)
+            wanted = new_category_name.casefold()
+            cat = next((c for c in categories if c.name.casefold() == wanted), None)
             if not cat:
-                cat = Category(name=new_category_name)
-                db.session.add(cat)
-                db.session.flush()
+                # INSERT OR IGNORE: параллельная отправка той же формы
+                # упрётся в уникальный индекс, а не создаст дубль
+                db.session.execute(
+                    sqlite_insert(Category)
+                    .values(name=new_category_name)
+                    .on_conflict_do_nothing()
+                )
+                cat = db.session.scalar(
+                    select(Category)
+                    .where(func.lower(Category.name) == func.lower(new_category_name))
+                )
             book.category = cat
         else:
             # иначе берём выбранный в селекте
@@ -363,10 +643,9 @@ def _book_form(book: Book | None = None):
         else:
             book.year = None
         # цена
-        price_raw = f["price"].replace(",", ".")
         try:
-            book.price = Decimal(price_raw)
-        except Exception:
+            book.price = parse_price(f["price"])
+        except ValueError:
             flash("Некорректное значение цены", "danger")
             return redirect(request.url)
 
@@ -374,14 +653,16 @@ def _book_form(book: Book | None = None):
 
         # обновить/загрузить картинку
         file = request.files.get("photo")
-        if file and allowed_file(file.filename):
-            fname = secure_filename(f"{datetime.utcnow().timestamp()}_{file.filename}")
-            os.makedirs(app.config["UPLOAD_FOLDER"], exist_ok=True)
-            file.save(os.path.join(app.config["UPLOAD_FOLDER"], fname))
-            book.cover = fname   # поле cover в модели Book
+        ext = image_extension(file) if file and allowed_file(file.filename) else None
+        if ext:
+            # имя файла – хэш содержимого: одинаковые обложки не дублируются,
+            # а новая обложка всегда получает новый URL. Расширение – по формату
+            # картинки, а не из имени файла (оно может быть, например, кириллическим)
+            book.cover = save_upload(file, ext)   # поле cover в модели Book
 
         db.session.add(book)
         db.session.commit()
+        invalidate_catalog()
         flash("Книга сохранена", "success")
         return redirect(url_for("my_books"))
 
@@ -398,9 +679,10 @@ def add_to_cart(book_id):
         flash("Эта книга уже куплена другим пользователем.", "warning")
         return redirect(request.referrer or url_for("books"))
 
-    session.setdefault("cart", [])
-    if book_id not in session["cart"]:
-        session["cart"].append(book_id)
+    cart = get_cart()
+    if str(book_id) not in cart:
+        cart[str(book_id)] = 1
+        session["cart"] = cart
         session.modified = True
 
     flash("Книга добавлена в корзину", "success")
@@ -411,22 +693,28 @@ def add_to_cart(book_id):
 @app.route("/cart")
 @login_required
 def cart():
-    cart_ids = session.get("cart", [])
-    books = Book.query.filter(Book.id.in_(cart_ids)).all() if cart_ids else []
+    cart_ids = cart_book_ids()
+    # для корзины хватает нескольких колонок – берём строки без ORM-объектов
+    books = db.session.execute(
+        select(Book.id, Book.title, Book.price, Book.cover, Book.year, Book.status)
+        .where(Book.id.in_(cart_ids))
+    ).all() if cart_ids else []
     total = sum(b.price for b in books)
     return render_template("cart.html", books=books, total=total)
 
 @app.route("/cart/remove/<int:book_id>", methods=["POST"])
 @login_required
 def cart_remove(book_id):
-    session["cart"] = [bid for bid in session.get("cart", []) if bid != book_id]
-    session.modified = True
+    cart = get_cart()
+    if cart.pop(str(book_id), None) is not None:
+        session["cart"] = cart
+        session.modified = True
     return redirect(url_for("cart"))
 
 @app.route("/cart/checkout", methods=["GET", "POST"])
 @login_required
 def cart_checkout():
-    cart_ids = session.get("cart", [])
+    cart_ids = cart_book_ids()
     if not cart_ids:
         flash("Корзина пуста", "warning")
         return redirect(url_for("books"))
@@ -435,7 +723,9 @@ def cart_checkout():
         # форма теперь на странице /cart
         return redirect(url_for("cart"))
 
-    books = Book.query.filter(Book.id.in_(cart_ids)).all()
+    books = db.session.execute(
+        select(Book.id, Book.price).where(Book.id.in_(cart_ids))
+    ).all()
     if not books:
         flash("Корзина пуста", "warning")
         return redirect(url_for("books"))
@@ -461,28 +751,29 @@ def cart_checkout():
         email=email or None,
         comment=comment or None,
         status="new",
+        total=sum(b.price for b in books),
     )
     db.session.add(order)
     db.session.flush()  # чтобы получить order.id
 
-    total = Decimal("0.00")
-    for b in books:
-        db.session.add(
-            OrderItem(
-                order_id=order.id,
-                book_id=b.id,
-                price_at_time=b.price,
-                quantity=1,
-            )
-        )
-        total += b.price
+    # позиции заказа – одним INSERT на все книги
+    db.session.execute(
+        OrderItem.__table__.insert(),
+        [
+            {"order_id": order.id, "book_id": b.id, "price_at_time": b.price, "quantity": 1}
+            for b in books
+        ],
+    )
 
-        # книга оформлена – скрываем из каталога
-        b.is_available = False
+    # книги оформлены – скрываем из каталога одним UPDATE
+    db.session.execute(
+        Book.__table__.update()
+        .where(Book.id.in_([b.id for b in books]))
+        .values(is_available=False)
+    )
 
-    order.total = total
     db.session.commit()
-
+    invalidate_catalog()
 
     session.pop("cart", None)
     flash("Заказ оформлен!", "success")
@@ -492,31 +783,84 @@ def cart_checkout():
 @app.route("/orders")
 @login_required
 def orders():
-    orders_ = (
-        Order.query
-        .filter(
+    orders_ = db.paginate(
+        select(Order)
+        .where(
             Order.user_id == current_user.id,
             Order.status != "cancelled"   # не показываем отменённые
         )
-        .order_by(Order.creation_date.desc())
-        .all()
+        .options(selectinload(Order.items).selectinload(OrderItem.book))
+        .order_by(Order.creation_date.desc()),
+        page=request.args.get("page", 1, type=int),
+        per_page=app.config["PER_PAGE"],
+        error_out=False,
     )
-    return render_template("orders.html", orders=orders_)
+    return render_template("orders.html", orders=orders_.items, pagination=orders_)
 
 # # ────────────  админка  ────────────
 
+@cache.memoize(timeout=30)
+def dashboard_stats() -> dict:
+    """
+    Сводные счётчики для главной страницы админки.
+    Кэш сбрасывается вместе с каталогом (invalidate_catalog) при изменениях.
+    """
+    orders_by_status = dict(db.session.execute(
+        select(Order.status, func.count()).group_by(Order.status)
+    ).all())
+    return {
+        "users": db.session.scalar(select(func.count()).select_from(User)),
+        "books": db.session.scalar(select(func.count()).select_from(Book)),
+        "books_available": db.session.scalar(
+            select(func.count()).select_from(Book).where(Book.is_available == True)
+        ),
+        "orders_by_status": orders_by_status,
+        "orders": sum(orders_by_status.values()),
+        "revenue": db.session.scalar(
+            select(func.coalesce(func.sum(Order.total), 0)).where(Order.status == "completed")
+        ),
+    }
+
+def _admin_page(query):
+    return db.paginate(
+        query,
+        page=request.args.get("page", 1, type=int),
+        per_page=app.config["PER_PAGE"],
+        error_out=False,
+    )
+
 @app.route("/admin")
 @admin_required
 def admin_dashboard():
-    users = User.query.order_by(User.id.asc()).all()
-    books = Book.query.order_by(Book.created_at.desc()).all()
-    orders_ = Order.query.order_by(Order.creation_date.desc()).all()
-    return render_template(
-        "admin_dashboard.html",
-        users=users,
-        books=books,
-        orders=orders_
+    return render_template("admin_dashboard.html", stats=dashboard_stats())
+
+@app.route("/admin/users")
+@admin_required
+def admin_users():
+    pagination = _admin_page(select(User).order_by(User.id.asc()))
+    return render_template("admin_users.html", users=pagination.items, pagination=pagination)
+
+@app.route("/admin/books")
+@admin_required
+def admin_books():
+    # жанр и владелец подгружаются сразу,
+    # иначе шаблон делает отдельный SELECT на каждую строку таблицы
+    pagination = _admin_page(
+        select(Book)
+        .options(selectinload(Book.category), selectinload(Book.owner))
+        .order_by(Book.created_at.desc())
     )
+    return render_template("admin_books.html", books=pagination.items, pagination=pagination)
+
+@app.route("/admin/orders")
+@admin_required
+def admin_orders():
+    pagination = _admin_page(
+        select(Order)
+        .options(selectinload(Order.user))
+        .order_by(Order.creation_date.desc())
+    )
+    return render_template("admin_orders.html", orders=pagination.items, pagination=pagination)
 
 @app.route("/admin/users/<int:user_id>/status", methods=["POST"])
 @admin_required
@@ -528,7 +872,7 @@ def admin_set_user_status(user_id):
     user.status = status
     db.session.commit()
     flash("Статус пользователя обновлён", "success")
-    return redirect(url_for("admin_dashboard"))
+    return redirect(url_for("admin_users"))
 
 @app.route("/orders/<int:order_id>/edit", methods=["GET", "POST"])
 @login_required
@@ -543,7 +887,7 @@ def order_edit(order_id):
     if order.status in ("completed", "cancelled"):
         flash("Этот заказ нельзя редактировать", "warning")
         return redirect(url_for("orders") if not current_user.is_admin
-                        else url_for("admin_dashboard"))
+                        else url_for("admin_orders"))
 
     if request.method == "POST":
         f = request.form
@@ -568,20 +912,25 @@ def order_edit(order_id):
         # ---------- обработка редактирования списка книг ----------
         keep_ids = [int(bid) for bid in f.getlist("books")]
 
-        # Удаляем те OrderItem, книг которых нет в "оставленных"
-        for item in list(order.items):
-            if item.book_id not in keep_ids:
-                db.session.delete(item)
+        # Удаляем одним DELETE те OrderItem, книг которых нет в "оставленных",
+        # и возвращаем эти книги в каталог
+        removed_book_ids = db.session.scalars(
+            OrderItem.__table__.delete()
+            .where(OrderItem.order_id == order.id, OrderItem.book_id.not_in(keep_ids))
+            .returning(OrderItem.book_id)
+        ).all()
+        release_books(removed_book_ids)
+        db.session.expire(order, ["items"])
 
-        # Обновляем БД и пересчитываем сумму
-        db.session.flush()
-        recalc_order_total(order)       
+        # пересчитываем сумму
+        recalc_order_total(order)
 
         db.session.commit()
+        invalidate_catalog()
         flash("Заказ обновлён", "success")
 
         return redirect(url_for("orders") if not current_user.is_admin
-                        else url_for("admin_dashboard"))
+                        else url_for("admin_orders"))
 
     return render_template("order_edit.html", order=order)
 
@@ -597,15 +946,16 @@ def order_cancel(order_id):
         flash("Этот заказ нельзя отменить", "warning")
     else:
         # вернуть все книги из заказа в каталог
-        for item in order.items:
-            if hasattr(item.book, "is_available"):
-                item.book.is_available = True
+        release_books(db.session.scalars(
+            select(OrderItem.book_id).where(OrderItem.order_id == order.id)
+        ).all())
 
         order.status = "cancelled"
         db.session.commit()
+        invalidate_catalog()
         flash("Заказ отменён", "info")
 
-    return redirect(url_for("orders") if not current_user.is_admin else url_for("admin_dashboard"))
+    return redirect(url_for("orders") if not current_user.is_admin else url_for("admin_orders"))
 
 @app.route("/orders/<int:order_id>/items/<int:item_id>/delete", methods=["POST"])
 @login_required
@@ -622,9 +972,8 @@ def order_item_delete(order_id, item_id):
         .first_or_404()
     )
 
-    # вернуть книгу в каталог (если используешь is_available)
-    if hasattr(item.book, "is_available"):
-        item.book.is_available = True
+    # вернуть книгу в каталог
+    release_books([item.book_id])
 
     # удаляем позицию
     db.session.delete(item)
@@ -633,15 +982,19 @@ def order_item_delete(order_id, item_id):
     recalc_order_total(order)
 
     # если в заказе больше нет книг — помечаем его отменённым
-    if len(order.items) == 0:
+    items_left = db.session.scalar(
+        select(func.count(OrderItem.id)).where(OrderItem.order_id == order.id)
+    )
+    if items_left == 0:
         order.status = "cancelled"
 
     db.session.commit()
+    invalidate_catalog()
 
     flash("Книга удалена из заказа", "info")
     return redirect(
         url_for("orders") if not current_user.is_admin
-        else url_for("admin_dashboard")
+        else url_for("admin_orders")
     )
 @app.route("/orders/<int:order_id>/delete", methods=["POST"])
 @login_required
@@ -652,19 +1005,18 @@ def order_delete(order_id):
     if order.user_id != current_user.id and not current_user.is_admin:
         abort(403)
 
-    # вернуть книги в каталог, если используешь is_available
-    for item in order.items:
-        if hasattr(item.book, "is_available"):
-            item.book.is_available = True
+    # вернуть книги в каталог (позиции всё равно загрузятся для каскадного удаления)
+    release_books([item.book_id for item in order.items])
 
     # удалить сам заказ
     db.session.delete(order)
     db.session.commit()
+    invalidate_catalog()
 
     flash("Заказ удалён", "info")
     return redirect(
         url_for("orders") if not current_user.is_admin
-        else url_for("admin_dashboard")
+        else url_for("admin_orders")
     )
 
 
@@ -680,8 +1032,9 @@ def admin_set_order_status(order_id):
 
     order.status = status
     db.session.commit()
+    invalidate_catalog()
     flash("Статус заказа обновлён", "success")
-    return redirect(url_for("admin_dashboard"))
+    return redirect(url_for("admin_orders"))
 
 
 
@@ -1,6 +1,44 @@
 # init_db.py
-from app import db, app
+from sqlalchemy.schema import CreateIndex
+
+from app import BOOKS_FTS_DDL, db, app
+
+# колонки, которые раньше были Numeric(10, 2), а теперь хранят целые копейки
+PRICE_COLUMNS = (
+    ("books", "price"),
+    ("order_items", "price_at_time"),
+    ("orders", "total"),
+)
+
+def migrate_prices_to_cents(conn) -> None:
+    """
+    Однократно перевести цены из рублей в копейки в базе, созданной до перехода.
+    Выполненную миграцию отмечаем в PRAGMA user_version.
+    """
+    if conn.exec_driver_sql("PRAGMA user_version").scalar() >= 1:
+        return
+    columns = {row[1]: row[2] for row in conn.exec_driver_sql("PRAGMA table_info(books)")}
+    # в свежей базе create_all уже создал INTEGER-колонки – пересчитывать нечего
+    if columns.get("price", "").upper().startswith("NUMERIC"):
+        for table, column in PRICE_COLUMNS:
+            conn.exec_driver_sql(
+                f"UPDATE {table} SET {column} = CAST(ROUND({column} * 100) AS INTEGER) "
+                f"WHERE {column} IS NOT NULL"
+            )
+    conn.exec_driver_sql("PRAGMA user_version = 1")
 
 with app.app_context():
     db.create_all()
+    # create_all не трогает уже существующие таблицы –
+    # досоздаём индексы, добавленные в модели позже
+    # (IF NOT EXISTS, т.к. индексы по выражениям SQLAlchemy не видит при проверке)
+    with db.engine.begin() as conn:
+        for table in db.metadata.sorted_tables:
+            for index in table.indexes:
+                conn.execute(CreateIndex(index, if_not_exists=True))
+        migrate_prices_to_cents(conn)
+        # поисковый индекс для базы, созданной до его появления, и его пересборка
+        for stmt in BOOKS_FTS_DDL:
+            conn.exec_driver_sql(stmt)
+        conn.exec_driver_sql("INSERT INTO books_fts(books_fts) VALUES ('rebuild')")
     print("База данных создана!")